@@ -1,26 +1,93 @@
 import asyncio
-from collections import namedtuple
-from functools import lru_cache, reduce
+import concurrent.futures
+from dataclasses import dataclass
+import functools
+from itertools import chain
+import os
 import pathlib
 import subprocess
-import sys
 
 DRY_RUN = True
-Error = namedtuple('Error', 'reason')
-Ok = namedtuple('Ok', 'changed')
+
+
+class Result:
+    __slots__ = ()
+
+
+@dataclass(frozen=True)
+class Error(Result):
+    __slots__ = ('reason',)
+    reason: str
+
+
+@dataclass(frozen=True)
+class Ok(Result):
+    __slots__ = ('changed',)
+    changed: bool
+
+
+_spawn_pool = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+# each communicate() holds its thread until the child exits, so waits get
+# their own, larger pool and can't starve new spawns
+_wait_pool = concurrent.futures.ThreadPoolExecutor(max_workers=128)
+
+
+def once(method):
+    """Run a coroutine method at most once per object and event loop; later
+    calls share its result.
+
+    The running future is stored on the object itself, so the object needs a
+    __dict__; classes have one, which is what the classmethod flushes rely on.
+    Each caller awaits it through a shield, so cancelling one caller doesn't
+    cancel the run the others are waiting on.
+    """
+    name = '_once_' + method.__name__
+
+    @functools.wraps(method)
+    async def wrapper(self):
+        future = self.__dict__.get(name)
+        if future is None or future.get_loop() is not asyncio.get_running_loop():
+            future = asyncio.ensure_future(method(self))
+            setattr(self, name, future)
+        return await asyncio.shield(future)
+    return wrapper
+
+
+@functools.lru_cache(maxsize=4096)
+def _path(s):
+    return pathlib.Path(s)
 
 
 async def run(*args):
-    echo = ['echo'] if DRY_RUN else []
-    process = await asyncio.create_subprocess_exec(
-        *echo, *args,
+    if DRY_RUN:
+        print(*args)
+        return b'', b''
+    loop = asyncio.get_running_loop()
+    spawn = loop.run_in_executor(_spawn_pool, functools.partial(
+        subprocess.Popen,
+        args,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-    )
-    stdout, stderr = await process.communicate()
-    if DRY_RUN:
-        sys.stdout.buffer.write(stdout)
-    return stdout, stderr
+    ))
+    try:
+        process = await asyncio.shield(spawn)
+    except asyncio.CancelledError:
+        # the Popen call can't be interrupted; kill the child once it exists
+        spawn.add_done_callback(_kill_spawned)
+        raise
+    try:
+        return await loop.run_in_executor(_wait_pool, process.communicate)
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+
+
+def _kill_spawned(spawn):
+    if spawn.cancelled() or spawn.exception() is not None:
+        return
+    process = spawn.result()
+    process.kill()
+    _wait_pool.submit(process.wait)
 
 
 class ValidationError(Exception):
@@ -28,11 +95,51 @@ class ValidationError(Exception):
 
 
 class Command:
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        # Commands have a fixed set of slots, so write each class a
+        # straight-line __repr__ instead of walking them on every call
+        super().__init_subclass__(**kwargs)
+        # leave alone any __repr__ written by hand, here or in a parent
+        inherited = cls.__repr__
+        if inherited is not Command.__repr__ and not getattr(inherited, '_generated', False):
+            return
+        if '__slots__' not in cls.__dict__:
+            # instances have a __dict__, so the generic repr is needed to
+            # see their attributes; don't inherit a parent's generated one
+            cls.__repr__ = Command.__repr__
+            return
+        varlist = ''.join(
+            ' {0}={{self.{0}}}'.format(name)
+            for klass in reversed(cls.__mro__)
+            for name in vars(klass).get('__slots__', ())
+            if not name.startswith('_')
+        )
+        namespace = {'Command': Command}
+        exec(
+            "def __repr__(self):\n"
+            "    try:\n"
+            "        return f'<{}{}>'\n"
+            "    except AttributeError:\n"
+            "        return Command.__repr__(self)\n".format(cls.__name__, varlist),
+            namespace,
+        )
+        namespace['__repr__'].__qualname__ = cls.__qualname__ + '.__repr__'
+        namespace['__repr__']._generated = True
+        cls.__repr__ = namespace['__repr__']
+
     def __repr__(self):
+        names = [
+            name
+            for klass in reversed(type(self).__mro__)
+            for name in vars(klass).get('__slots__', ())
+        ]
+        names.extend(getattr(self, '__dict__', ()))
         varlist = ' '.join(
-            '{}={}'.format(name, value)
-            for name, value in vars(self).items()
-            if not name.startswith('_')
+            '{}={}'.format(name, getattr(self, name))
+            for name in names
+            if not name.startswith('_') and hasattr(self, name)
         )
         return '<{}{}>'.format(self.__class__.__name__, ' ' + varlist if varlist else '')
 
@@ -41,22 +148,29 @@ class Command:
 
 
 class Nothing(Command):
+    __slots__ = ()
+
     async def do(self):
-        pass
+        return Ok(changed=False)
 
 
 class Check(Command):
+    __slots__ = ('exists', 'reason')
+
     def __init__(self, exists=None, reason=None):
         super().__init__()
-        self.exists = pathlib.Path(exists) if exists is not None else None
+        self.exists = _path(exists) if exists is not None else None
         self.reason = reason
 
     async def do(self):
+        return self.check()
+
+    def check(self):
         if self.exists:
             if self.exists.exists():
                 return Ok(changed=False)
             else:
-                return Error(reason)
+                return Error(self.reason or "{} does not exist".format(self.exists))
 
     def validate(self):
         if not self.exists:
@@ -64,17 +178,18 @@ class Check(Command):
 
 
 class File(Command):
+    __slots__ = ('destination', 'source')
+
     def __init__(self, destination, source=None):
         super().__init__()
-        self.destination = pathlib.Path(destination)
+        self.destination = _path(destination)
         assert self.destination.is_absolute()
         if source is None:
-            self.source = pathlib.Path(self.destination.name)
+            self.source = _path(self.destination.name)
         else:
-            self.source = pathlib.Path(source)
+            self.source = _path(source)
 
     async def do(self):
-        await asyncio.sleep(1)
         await run(
             'cp',
             str(self.source),
@@ -83,27 +198,25 @@ class File(Command):
         return Ok(changed=True)
 
 
-class Package(Command):
-    _instance = None
+class PackageBatch:
+    """Packages from every Package command, installed or removed together."""
     packages = {
         'install': set(),
         'remove': set(),
     }
 
-    def __new__(cls, *packages, action='install'):
-        assert action in cls.packages
-
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
-
+    @classmethod
+    def submit(cls, packages, action):
         cls.packages[action].update(packages)
-        return cls._instance
 
-    @lru_cache(maxsize=1)
-    async def do(self):
+    @classmethod
+    @once
+    async def flush(cls):
+        # pacman holds an exclusive lock on its database and can't mix -R
+        # and -S in one transaction, so these have to run one after the other
         for flags, packages in [
-            ('-Rs', self.packages['remove']),
-            ('-S', self.packages['install']),
+            ('-Rs', cls.packages['remove']),
+            ('-S', cls.packages['install']),
         ]:
             if packages:
                 await run(
@@ -113,13 +226,69 @@ class Package(Command):
                 )
         return Ok(changed=False)
 
+
+class Package(Command):
+    __slots__ = ('packages', 'action')
+
+    def __init__(self, *packages, action='install'):
+        super().__init__()
+        assert action in PackageBatch.packages
+        self.packages = packages
+        self.action = action
+        PackageBatch.submit(packages, action)
+
+    async def do(self):
+        return await PackageBatch.flush()
+
     def validate(self):
-        duplicate_packages = self.packages['install'] & self.packages['remove']
+        other = 'remove' if self.action == 'install' else 'install'
+        duplicate_packages = set(self.packages) & PackageBatch.packages[other]
         if duplicate_packages:
             raise ValidationError("packages being both installed and removed: %r" % duplicate_packages)
 
 
+class ServiceBatch:
+    """Services from every Service command, with one systemctl call per action."""
+    actions = {}
+    configs = []
+    files = []
+
+    @classmethod
+    def submit(cls, name, action, config, file):
+        cls.actions.setdefault(action, set()).add(name)
+        cls.configs.append((name, config))
+        cls.files.append(file)
+
+    @classmethod
+    @once
+    async def flush(cls):
+        results = await asyncio.gather(*(
+            command.do()
+            for command in chain((config for _, config in cls.configs), cls.files)
+        ))
+        for action, names in sorted(cls.actions.items()):
+            await run(
+                'systemctl',
+                action,
+                *sorted(names),
+            )
+        reload = {
+            name
+            for (name, _), result in zip(cls.configs, results)
+            if result.changed
+        }
+        if reload:
+            await run(
+                'systemctl',
+                'reload',
+                *sorted(reload),
+            )
+        return Ok(changed=False)
+
+
 class Service(Command):
+    __slots__ = ('name', 'action', 'config', 'file')
+
     def __init__(self, name, action='enable', config=Nothing(), file=Nothing()):
         super().__init__()
         self.name = name
@@ -128,40 +297,66 @@ class Service(Command):
         self.file = file
         assert isinstance(self.config, Command)
         assert isinstance(self.file, Command)
+        ServiceBatch.submit(name, action, config, file)
 
     async def do(self):
-        config_result = await self.config.do()
-        file_result = await self.file.do()
+        return await ServiceBatch.flush()
+
+    def validate(self):
+        actions = {
+            action
+            for action, names in ServiceBatch.actions.items()
+            if self.name in names
+        }
+        if len(actions) > 1:
+            raise ValidationError("service given more than one action: %r" % actions)
+
+
+class UserBatch:
+    """Users from every User command, added one at a time."""
+    users = set()
+
+    @classmethod
+    def submit(cls, name, homedir, system):
+        cls.users.add((name, homedir, system))
+
+    @classmethod
+    @once
+    async def flush(cls):
+        # useradd locks /etc/passwd and /etc/shadow, so concurrent runs
+        # would fail; add the users one at a time
+        for name, homedir, system in sorted(cls.users):
+            await cls._useradd(name, homedir, system)
+        return Ok(changed=False)
+
+    @staticmethod
+    async def _useradd(name, homedir, system):
+        args = []
+        if homedir:
+            args.append('--create-home')
+        if system:
+            args.append('--system')
         await run(
-            'systemctl',
-            self.action,
-            self.name,
+            'useradd',
+            *args,
+            name,
         )
-        if config_result.changed:
-            await run(
-                'systemctl',
-                'reload',
-                self.name,
-            )
-        return Ok(changed=False)
 
 
 class User(Command):
+    __slots__ = ('name', 'homedir', 'system')
+
     def __init__(self, name, homedir=False, system=False):
         super().__init__()
         self.name = name
         self.homedir = homedir
         self.system = system
+        UserBatch.submit(name, homedir, system)
 
     async def do(self):
-        args = []
-        if self.homedir:
-            args.append('--create-home')
-        if self.system:
-            args.append('--system')
-        await run(
-            'useradd',
-            *args,
-            self.name,
-        )
-        return Ok(changed=False)
+        return await UserBatch.flush()
+
+    def validate(self):
+        definitions = {user for user in UserBatch.users if user[0] == self.name}
+        if len(definitions) > 1:
+            raise ValidationError("user defined more than once with different options")
@@ -1,5 +1,9 @@
 import asyncio
-import contextlib
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from dostuff.commands import *
 
@@ -25,7 +29,25 @@ if errors:
         print("error: {} in {}".format(e, command))
     raise SystemExit
 
-stuff = asyncio.gather(*(command.do() for command in commands))
 
-with contextlib.closing(asyncio.get_event_loop()) as loop:
-    loop.run_until_complete(stuff)
+def report(result):
+    if isinstance(result, Error):
+        print("error: {}".format(result.reason))
+
+
+# checks are a single stat each; run them directly instead of as tasks
+checks = [command for command in commands if isinstance(command, Check)]
+others = [command for command in commands if not isinstance(command, Check)]
+for check in checks:
+    report(check.check())
+
+
+async def main():
+    for result in asyncio.as_completed([command.do() for command in others]):
+        report(await result)
+
+
+# uvloop.run only exists in uvloop 0.18 and later; it passes uvloop's loop
+# as asyncio.run's loop_factory on 3.12+, leaving the global policy alone
+runner = getattr(uvloop, 'run', None) or asyncio.run
+runner(main())